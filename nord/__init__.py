@@ -19,35 +19,55 @@
 import logging
 import structlog
 
-from ._version import __version__
-del _version  # pylint: disable=undefined-variable
 
-from . import vpn, api
+# Set up default logging on import, in case nord is used as a library
 
+# Register the custom 'trace' level before configuring structlog, so that
+# the level maps are complete before any logger is created.
+# pylint: disable=protected-access
+structlog.stdlib.TRACE = 5
+structlog.stdlib._NAME_TO_LEVEL['trace'] = 5
+structlog.stdlib._LEVEL_TO_NAME[5] = 'trace'
+logging.addLevelName(5, "TRACE")
 
-# Set up default logging on import, in case nord is used as a library
+_PROCESSORS = (
+    structlog.stdlib.filter_by_level,
+    structlog.stdlib.add_logger_name,
+    structlog.stdlib.add_log_level,
+    structlog.processors.TimeStamper(fmt="%x:%X", utc=False),
+    structlog.processors.UnicodeDecoder(),
+)
 
 structlog.configure(
-    processors=[
-        structlog.stdlib.filter_by_level,
-        structlog.stdlib.add_logger_name,
-        structlog.stdlib.add_log_level,
-        structlog.processors.TimeStamper(fmt="%x:%X", utc=False),
-        structlog.processors.UnicodeDecoder(),
-    ],
+    processors=_PROCESSORS,
     logger_factory=structlog.stdlib.LoggerFactory(),
     wrapper_class=structlog.stdlib.BoundLogger,
     cache_logger_on_first_use=True,
     context_class=dict,
 )
 
-# pylint: disable=protected-access
-structlog.stdlib.TRACE = 5
-structlog.stdlib._NAME_TO_LEVEL['trace'] = 5
-structlog.stdlib._LEVEL_TO_NAME[5] = 'trace'
-logging.addLevelName(5, "TRACE")
 
-# Even after we remove these references, these are still present in
-# sys.modules, so they remain loaded.
-del structlog
-del logging
+def get_logger(name, **initial_values):
+    """Return a structlog logger for the named module.
+
+    The logger is a lazy proxy that is only bound on first use, so it
+    may be created at import time and still pick up any configuration
+    done later (e.g. by the command-line interface).
+    """
+    return structlog.get_logger(name, **initial_values)
+
+
+_SUBMODULES = frozenset(['api', 'vpn', 'web'])
+
+
+def __getattr__(name):
+    # Import submodules on first access, so that importing 'nord'
+    # (e.g. for 'nord --help') does not pull in aiohttp.
+    if name in _SUBMODULES:
+        import importlib
+        return importlib.import_module(f'.{name}', __name__)
+    # Determining the version may run 'git', so only do it on demand.
+    if name == '__version__':
+        from ._version import __version__
+        return __version__
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
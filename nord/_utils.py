@@ -17,18 +17,22 @@
 """Miscellaneous utilities."""
 
 import os
+import re
+import time
+import errno
 import fcntl
+import struct
+import shutil
+import signal
+import socket
 import tempfile
 import functools as ft
 import asyncio
+import weakref
 from asyncio.subprocess import PIPE, DEVNULL
-from asyncio import create_subprocess_exec as subprocess
 from subprocess import SubprocessError
-from collections import OrderedDict
 from pathlib import Path
 
-from decorator import decorator
-
 
 # Generic utilities
 
@@ -38,14 +42,16 @@ def silence(*exceptions_to_silence):
     this is a coroutine decorator.
     """
 
-    async def _wrapper(func, *args, **kwargs):
-        try:
-            return await func(*args, **kwargs)
-        except Exception as error:
-            if not isinstance(error, exceptions_to_silence):
-                raise
+    def _decorator(func):
+        @ft.wraps(func)
+        async def _wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except exceptions_to_silence:
+                pass
+        return _wrapper
 
-    return decorator(_wrapper)
+    return _decorator
 
 
 class MultiError(Exception):
@@ -65,63 +71,157 @@ class multi_context:  # pylint: disable=invalid-name,too-few-public-methods
         self.managers = managers
 
     async def __aenter__(self):
-        futures = [asyncio.ensure_future(m.__aenter__())
-                   for m in self.managers]
-        await asyncio.wait(futures)  # make sure all are run to completion
-        exceptions = [f.exception() for f in futures if f.exception()]
-        if exceptions:
-            first_exception, *other_exceptions = exceptions
-            if not other_exceptions:
-                raise first_exception
-            else:
-                MultiError(first_exception, *other_exceptions)
+        results = await asyncio.gather(
+            *(m.__aenter__() for m in self.managers),
+            return_exceptions=True,
+        )
+        exceptions = [r for r in results if isinstance(r, BaseException)]
+        if len(exceptions) == 1:
+            raise exceptions[0]
+        elif exceptions:
+            raise MultiError(*exceptions)
 
     async def __aexit__(self, *exc_details):
-        futures = [m.__aexit__(*exc_details) for m in self.managers]
-        await asyncio.wait(futures)  # make sure all are run to completion
+        await asyncio.gather(
+            *(m.__aexit__(*exc_details) for m in self.managers),
+            return_exceptions=True,
+        )
 
 
-@decorator
-def run_sync(func, *args, **kwargs):
-    """Run the decorated coroutine synchronouslyin the default event loop.
+def run_sync(func):
+    """Run the decorated coroutine synchronously in a new event loop.
 
     This decordator converts an async function to a regular function.
     """
-    return asyncio.get_event_loop().run_until_complete(func(*args, **kwargs))
+    @ft.wraps(func)
+    def _wrapper(*args, **kwargs):
+        return asyncio.run(func(*args, **kwargs))
+    return _wrapper
 
 
-# Created by Github user 'jaredlunde':
-# https://gist.github.com/jaredlunde/7a118c03c3e9b925f2bf
-# with minor modifications.
 def async_lru_cache(size=float('inf')):
-    """LRU cache for coroutines."""
-    cache = OrderedDict()
+    """LRU cache for coroutines.
+
+    Concurrent calls with the same arguments share a single
+    invocation of the decorated coroutine. Only the results of
+    calls that complete successfully are cached.
+    """
+    cache = {}  # insertion order is the order of most recent use
+    in_flight = {}
+
+    def _decorator(func):
+        @ft.wraps(func)
+        async def _memoized(*args, **kwargs):
+            # pylint: disable=protected-access
+            key = ft._make_key(args, kwargs, typed=False)
+            try:
+                result = cache.pop(key)
+            except KeyError:
+                pass
+            else:
+                cache[key] = result
+                return result
+
+            task = in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                in_flight[key] = task
+                task.add_done_callback(ft.partial(_finished, key))
+            # shield, so cancelling one caller does not cancel the others
+            return await asyncio.shield(task)
+        return _memoized
+
+    def _finished(key, task):
+        if in_flight.get(key) is task:
+            del in_flight[key]
+        # retrieving the exception also stops asyncio from warning
+        # about it when every caller was cancelled
+        if task.cancelled() or task.exception() is not None:
+            return
+        if len(cache) >= size:
+            del cache[next(iter(cache))]
+        cache[key] = task.result()
+
+    return _decorator
+
+
+_SPAWN_CONCURRENCY = 16
+# One semaphore per event loop, as they cannot be shared between loops
+_SPAWN_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+def set_spawn_concurrency(limit):
+    """Set the maximum number of subprocesses that may be launched at once.
+
+    This limits concurrent process creation, not the number of
+    subprocesses that may be running at the same time.
+    """
+    # pylint: disable=global-statement
+    global _SPAWN_CONCURRENCY
+    if limit < 1:
+        raise ValueError("'limit' must be at least 1")
+    _SPAWN_CONCURRENCY = int(limit)
+    _SPAWN_SEMAPHORES.clear()
 
-    async def _memoized(func, *args, **kwargs):
-        key = str((args, kwargs))
-        if key not in cache:
-            if len(cache) >= size:
-                cache.popitem(last=False)
-            cache[key] = await func(*args, **kwargs)
-        return cache[key]
 
-    return decorator(_memoized)
+async def subprocess(*args, **kwargs):
+    """Launch a subprocess; see 'asyncio.create_subprocess_exec'."""
+    loop = asyncio.get_running_loop()
+    semaphore = _SPAWN_SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(_SPAWN_CONCURRENCY)
+        _SPAWN_SEMAPHORES[loop] = semaphore
+    async with semaphore:
+        return await asyncio.create_subprocess_exec(*args, **kwargs)
 
 
 def write_to_tmp(content):
-    """Write text content to a temporary file a return a handle to it."""
-    tmp = tempfile.NamedTemporaryFile(mode='w+t')
-    tmp.write(content)
+    """Write text content to a temporary file a return a handle to it.
+
+    The path to the file is available as the handle's 'name'. On Linux
+    the file is anonymous and exists only in memory; its path is valid
+    until the handle is closed.
+    """
+    if not hasattr(os, 'memfd_create'):
+        tmp = tempfile.NamedTemporaryFile(mode='w+t')
+        tmp.write(content)
+        tmp.flush()
+        return tmp
+
+    fd = os.memfd_create('nord', os.MFD_CLOEXEC)
+    tmp = open(fd, 'w+b')
+    tmp.write(content.encode())
     tmp.flush()
+    # Other processes (e.g. OpenVPN running as root) can open the file here.
+    tmp.raw.name = f'/proc/{os.getpid()}/fd/{fd}'
     return tmp
 
 
 # Sudo-related functions
 
+# How long (in seconds) to trust a successful check of the sudo credentials.
+# This is much shorter than sudo's own credential cache timeout.
+SUDO_CACHE_TTL = 5.0
+_SUDO_CACHE = {'valid_until': 0.0}
+
+
+def _sudo_credentials_valid(valid):
+    if valid:
+        _SUDO_CACHE['valid_until'] = time.monotonic() + SUDO_CACHE_TTL
+    else:
+        _SUDO_CACHE['valid_until'] = 0.0
+
+
 async def sudo_requires_password():
-    """Return True if 'sudo' requires a password to run."""
+    """Return True if 'sudo' requires a password to run.
+
+    Successful checks are cached for 'SUDO_CACHE_TTL' seconds.
+    """
+    if time.monotonic() < _SUDO_CACHE['valid_until']:
+        return False
     proc = await subprocess('sudo', '-n', '-v', stdout=DEVNULL, stderr=DEVNULL)
     await proc.wait()
+    _sudo_credentials_valid(proc.returncode == 0)
     return proc.returncode != 0
 
 
@@ -129,17 +229,20 @@ async def prompt_for_sudo():
     """Run 'sudo' to prompt the user for their password."""
     proc = await subprocess('sudo', '-v')
     await proc.wait()
+    _sudo_credentials_valid(proc.returncode == 0)
     if proc.returncode != 0:
         raise PermissionError('sudo requires a password')
 
 
-@decorator
-async def require_sudo(func, *args, **kwargs):
+def require_sudo(func):
     """Raise PermissionError if 'sudo' cannot be used without a password."""
-    if await sudo_requires_password():
-        raise PermissionError('sudo requires a password')
-    else:
-        return await func(*args, **kwargs)
+    @ft.wraps(func)
+    async def _wrapper(*args, **kwargs):
+        if await sudo_requires_password():
+            raise PermissionError('sudo requires a password')
+        else:
+            return await func(*args, **kwargs)
+    return _wrapper
 
 
 class maintain_sudo:  # pylint: disable=invalid-name,too-few-public-methods
@@ -155,14 +258,14 @@ class maintain_sudo:  # pylint: disable=invalid-name,too-few-public-methods
 
         async def _maintainer():
             while True:
-                await asyncio.wait([prompt_for_sudo(),
-                                    asyncio.sleep(self.timeout)])
+                await asyncio.sleep(self.timeout)
+                await prompt_for_sudo()
 
         self.maintainer = asyncio.ensure_future(_maintainer())
 
     async def __aexit__(self, *exc_info):
         self.maintainer.cancel()
-        await self.maintainer
+        await asyncio.gather(self.maintainer, return_exceptions=True)
 
 
 # Functions requiring sudo
@@ -203,6 +306,7 @@ class replace_content_as_root:
 
     This context manager uses subprocesses and 'sudo' with 'cat' and 'tee'
     to write the files, to avoid giving root permissions to *this* process.
+    The existing content is read and replaced by a single 'sudo' invocation.
 
     Parameters
     ----------
@@ -220,23 +324,19 @@ class replace_content_as_root:
         self.content = content.encode()
         self.saved_content = None
         self._write_content = ['sudo', '-n', 'tee', self.path]
-        self._read_content = ['sudo', '-n', 'cat', self.path]
+        # print the existing content and then replace it with stdin
+        self._swap_content = ['sudo', '-n', 'sh', '-c',
+                              'cat -- "$0" && cat > "$0"', self.path]
 
     async def __aenter__(self):
         # can't use 'require_sudo' decorator as this is an async generator.
         if await sudo_requires_password():
             raise PermissionError('sudo requires a password')
 
-        # get existing content from file
-        proc = await subprocess(*self._read_content, stdout=PIPE, stderr=PIPE)
-        self.saved_content, errors = await proc.communicate()
-        if proc.returncode != 0:
-            raise RuntimeError(errors.decode())
-
-        # write temporary content to file
-        proc = await subprocess(*self._write_content, stdout=DEVNULL,
+        # save existing content and write temporary content to file
+        proc = await subprocess(*self._swap_content, stdout=PIPE,
                                 stderr=PIPE, stdin=PIPE)
-        _, errors = await proc.communicate(self.content)
+        self.saved_content, errors = await proc.communicate(self.content)
         if proc.returncode != 0:
             raise RuntimeError(errors.decode())
 
@@ -256,6 +356,34 @@ class LockError(BlockingIOError):
     pass
 
 
+_BACKGROUND_TASKS = set()
+
+
+# Open file description locks (Linux >= 3.15, Python >= 3.9) are tied to
+# the open file, like 'flock' locks, but are also honored over NFS.
+if hasattr(fcntl, 'F_OFD_SETLK'):
+    # 'struct flock' covering the whole file: type, whence, start, len, pid
+    _OFD_LOCK = struct.pack('hhqqi', fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+    _OFD_UNLOCK = struct.pack('hhqqi', fcntl.F_UNLCK, os.SEEK_SET, 0, 0, 0)
+
+    def _try_lock(file):
+        try:
+            fcntl.fcntl(file, fcntl.F_OFD_SETLK, _OFD_LOCK)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                raise BlockingIOError(error.errno, error.strerror) from error
+            raise
+
+    def _release_lock(file):
+        fcntl.fcntl(file, fcntl.F_OFD_SETLK, _OFD_UNLOCK)
+else:
+    def _try_lock(file):
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _release_lock(file):
+        fcntl.flock(file, fcntl.LOCK_UN)
+
+
 async def lock_subprocess(*args, lockfile, **kwargs):
     """Acquire a lock for launching a subprocess.
 
@@ -281,14 +409,15 @@ async def lock_subprocess(*args, lockfile, **kwargs):
 
     file = open(lockfile, 'w', opener=ft.partial(os.open, mode=0o600))
     try:
-        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        _try_lock(file)
     except BlockingIOError as error:
+        file.close()
         raise LockError(lockfile) from error
     file.write(str(os.getpid()))  # write pid to lockfile
     file.flush()
 
     def _unlock(*_):
-        fcntl.flock(file, fcntl.LOCK_UN)
+        _release_lock(file)
         file.truncate(0)
         file.close()
 
@@ -299,11 +428,49 @@ async def lock_subprocess(*args, lockfile, **kwargs):
         raise
     else:
         when_dead = asyncio.ensure_future(proc.wait())
+        # Keep a reference so the task is not garbage collected before the
+        # process dies; the event loop only holds weak references to tasks.
+        _BACKGROUND_TASKS.add(when_dead)
+        when_dead.add_done_callback(_BACKGROUND_TASKS.discard)
         when_dead.add_done_callback(_unlock)
 
     return proc
 
 
+# Grace period (in seconds) for 'ping' to exit after its own timeout.
+# 'ping' only starts its timer after resolving the host, so a stalled
+# DNS lookup could otherwise block for much longer.
+PING_GRACE_PERIOD = 0.5
+
+
+async def _kill_and_reap(proc):
+    """Kill 'proc' and wait for it to exit, even if we are cancelled."""
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+    await asyncio.shield(proc.wait())
+
+
+async def _communicate_with_deadline(proc, timeout):
+    """Call 'proc.communicate()', killing 'proc' if it takes too long.
+
+    Raises asyncio.TimeoutError if 'proc' does not finish within
+    'timeout' + 'PING_GRACE_PERIOD' seconds.
+    """
+    try:
+        return await asyncio.wait_for(proc.communicate(),
+                                      timeout + PING_GRACE_PERIOD)
+    finally:
+        if proc.returncode is None:
+            await _kill_and_reap(proc)
+
+
+# Matches the summary line of 'ping', e.g.
+# "rtt min/avg/max/mdev = 10.1/11.2/12.3/0.5 ms"
+_PING_SUMMARY = re.compile(rb'=\s*[\d.]+/([\d.]+)/')
+
+
 async def ping(host, timeout):
     """Return the round-trip time to a host using ICMP ECHO.
 
@@ -322,17 +489,118 @@ async def ping(host, timeout):
 
     Raises
     ------
-    SubprocessError if 'ping' returns a non-zero exit code.
+    SubprocessError if 'ping' returns a non-zero exit code, does not
+    finish shortly after 'timeout', or its output cannot be parsed.
     """
     cmd = f"/bin/ping -w{int(timeout)} {host}"
-    proc = await asyncio.create_subprocess_exec(*cmd.split(),
-                                                stdout=PIPE, stderr=DEVNULL)
-    stdout, _ = await proc.communicate()
+    proc = await subprocess(*cmd.split(), stdout=PIPE, stderr=DEVNULL)
+    try:
+        stdout, _ = await _communicate_with_deadline(proc, timeout)
+    except asyncio.TimeoutError:
+        raise SubprocessError(f'ping {host} did not finish in time')
     if proc.returncode != 0:
         raise SubprocessError(proc.returncode)
 
-    *_, rtt_line, _ = stdout.decode().split('\n')
-    assert _ == ''  # sanity check
-    *_, data, _ = rtt_line.split()
-    _, avg, *_ = data.split('/')
-    return float(avg)
+    match = _PING_SUMMARY.search(stdout)
+    if not match:
+        raise SubprocessError(f'unexpected output from ping: {stdout[-100:]}')
+    return float(match.group(1))
+
+
+# Matches the per-host summary that 'fping -q -c' writes to stderr, e.g.
+# "us1.nordvpn.com : xmt/rcv/%loss = 2/2/0%, min/avg/max = 1.2/1.5/1.8"
+_FPING_SUMMARY = re.compile(rb'^(\S+)\s*:.*min/avg/max = [\d.]+/([\d.]+)/',
+                            re.MULTILINE)
+
+
+MAX_CONCURRENT_PINGS = 32
+
+
+async def ping_many(hosts, timeout):
+    """Return the round-trip times to several hosts using ICMP ECHO.
+
+    Uses a single 'fping' process if it is installed, otherwise
+    runs 'ping' for each host concurrently, with at most
+    'MAX_CONCURRENT_PINGS' running at once.
+
+    Parameters
+    ----------
+    hosts : iterable of str
+        The hosts to ping.
+    timeout : int
+        Time in seconds after which to stop waiting for responses.
+
+    Returns
+    -------
+    rtt : (dict: str → float)
+        Map from host to the average round trip time in milliseconds.
+        Hosts that did not respond are omitted.
+    """
+    hosts = list(hosts)
+    fping = shutil.which('fping')
+    if not fping:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_PINGS)
+
+        async def _ping(host):
+            async with semaphore:
+                try:
+                    return await ping(host, timeout)
+                except SubprocessError:
+                    return None
+        rtts = await asyncio.gather(*[_ping(host) for host in hosts])
+        return {host: rtt for host, rtt in zip(hosts, rtts)
+                if rtt is not None}
+
+    # Send one packet per second for 'timeout' seconds, like 'ping -w'.
+    cmd = [fping, '-q', f'-c{max(1, int(timeout))}', *hosts]
+    proc = await subprocess(*cmd, stdout=DEVNULL, stderr=PIPE)
+    # fping reports on stderr
+    read = asyncio.ensure_future(proc.stderr.read())
+    try:
+        try:
+            stderr = await asyncio.wait_for(asyncio.shield(read),
+                                            timeout + PING_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            # With many hosts fping can take longer than 'timeout' to
+            # send all its packets. On SIGINT it stops and still prints
+            # the summaries for the replies received so far.
+            try:
+                proc.send_signal(signal.SIGINT)
+            except ProcessLookupError:
+                pass
+            stderr = await asyncio.wait_for(read, PING_GRACE_PERIOD)
+        await proc.wait()
+    except asyncio.TimeoutError:
+        return {}
+    finally:
+        read.cancel()
+        if proc.returncode is None:
+            await _kill_and_reap(proc)
+    return {host.decode(): float(avg)
+            for host, avg in _FPING_SUMMARY.findall(stderr)}
+
+
+async def resolve_many(hosts):
+    """Resolve several hostnames concurrently.
+
+    Parameters
+    ----------
+    hosts : iterable of str
+
+    Returns
+    -------
+    addresses : (dict: str → str)
+        Map from host to one of its IP addresses.
+        Hosts that could not be resolved are omitted.
+    """
+    hosts = list(hosts)
+    loop = asyncio.get_running_loop()
+    # 'ping' and 'fping' are run without '-6', so only IPv4 is useful
+    results = await asyncio.gather(
+        *[loop.getaddrinfo(host, None, family=socket.AF_INET,
+                           type=socket.SOCK_STREAM)
+          for host in hosts],
+        return_exceptions=True)
+    # getaddrinfo returns (family, type, proto, canonname, sockaddr)
+    return {host: result[0][4][0] for host, result in zip(hosts, results)
+            if not isinstance(result, Exception) and result}
@@ -6,9 +6,6 @@ import os
 import subprocess
 import sys
 
-from distutils.command.build import build as build_orig
-from setuptools.command.sdist import sdist as sdist_orig
-
 Version = namedtuple('Version', ('release', 'dev', 'labels'))
 
 # No public API
@@ -139,6 +136,8 @@ __version__ = get_version()
 # The following section defines a module global 'cmdclass',
 # which can be used from setup.py. The 'package_name' and
 # '__version__' module globals are used (but not modified).
+# 'cmdclass' is created on first access, so that importing this module
+# at run time (e.g. for 'nord --version') does not import setuptools.
 
 def _write_version(fname):
     # This could be a hard link, so try to delete it first.  Is there any way
@@ -152,18 +151,26 @@ def _write_version(fname):
                 "version = '{}'\n".format(__version__))
 
 
-class _build(build_orig):
-    def run(self):
-        super().run()
-        _write_version(os.path.join(self.build_lib, package_name,
-                                    STATIC_VERSION_FILE))
+def _make_cmdclass():
+    from distutils.command.build import build as build_orig
+    from setuptools.command.sdist import sdist as sdist_orig
+
+    class _build(build_orig):
+        def run(self):
+            super().run()
+            _write_version(os.path.join(self.build_lib, package_name,
+                                        STATIC_VERSION_FILE))
 
+    class _sdist(sdist_orig):
+        def make_release_tree(self, base_dir, files):
+            super().make_release_tree(base_dir, files)
+            _write_version(os.path.join(base_dir, package_name,
+                                        STATIC_VERSION_FILE))
 
-class _sdist(sdist_orig):
-    def make_release_tree(self, base_dir, files):
-        super().make_release_tree(base_dir, files)
-        _write_version(os.path.join(base_dir, package_name,
-                                    STATIC_VERSION_FILE))
+    return dict(sdist=_sdist, build=_build)
 
 
-cmdclass = dict(sdist=_sdist, build=_build)
+def __getattr__(name):
+    if name == 'cmdclass':
+        return _make_cmdclass()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
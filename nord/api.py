@@ -19,41 +19,121 @@
 This module contains a single class, `Client`, which encapsulates
 all the methods provided by NordVPN.
 """
-from subprocess import SubprocessError
-from collections import defaultdict
-from hashlib import sha512
-import asyncio
+from collections.abc import Mapping
+from contextlib import suppress
+from functools import lru_cache
+from hashlib import sha256, sha512
+from pathlib import Path
+from types import MappingProxyType
+import os
+import re
+import tempfile
+import time
 
-from structlog import get_logger
 import aiohttp
+import orjson
+import yarl
 
+from . import get_logger
 from ._version import __version__
-from ._utils import async_lru_cache, ping
+from ._utils import async_lru_cache, ping_many, resolve_many
 
 
 PORTS = dict(tcp=443, udp=1194)
+_CONFIG_FILENAME = {protocol: f'{{}}.{protocol}{port}'.format
+                    for protocol, port in PORTS.items()}
 TRACE = 5  # custom log level
+# Seconds for which to remember that credentials were rejected.
+# Accepted credentials are remembered for the lifetime of the Client.
+INVALID_CREDENTIALS_TTL = 60
+# Responses that rarely change are cached on disk for this many seconds,
+# so that they are shared between invocations of the CLI.
+DISK_CACHE_TTL = 60
+# The XDG spec says to ignore relative paths in XDG_CACHE_HOME
+_XDG_CACHE_HOME = os.environ.get('XDG_CACHE_HOME', '')
+DISK_CACHE_DIR = (Path(_XDG_CACHE_HOME) if os.path.isabs(_XDG_CACHE_HOME)
+                  else Path.home() / '.cache') / 'nord'
+
+_HOSTNAME = re.compile(r'[A-Za-z0-9-]+(\.nordvpn\.com)?')
 
 
 # Low-level utilities
 
+@lru_cache(maxsize=4096)
 def normalized_hostname(hostname):
     """Return the fully qualified domain name of a NordVPN host."""
-    host, *domain = hostname.split('.')
-    if not domain:
-        return f'{host}.nordvpn.com'
-    elif tuple(domain) != ('nordvpn', 'com'):
+    match = _HOSTNAME.fullmatch(hostname)
+    if not match:
         raise ValueError(f'invalid NordVPN host {hostname}')
-    return hostname
+    return hostname if match.group(1) else f'{hostname}.nordvpn.com'
 
 
 def _config_filename(vpn_host, protocol='tcp'):
-    return f'{vpn_host}.{protocol}{PORTS[protocol]}'
+    return _CONFIG_FILENAME[protocol](vpn_host)
+
+
+class _HostLoads(Mapping):
+    """Read-only map from hostname to percentage load.
+
+    Wraps the response from the NordVPN 'server/stats' endpoint
+    without copying it.
+    """
+
+    def __init__(self, stats):
+        self._stats = stats
+
+    def __getitem__(self, host):
+        return self._stats[host]['percent']
+
+    def __iter__(self):
+        return iter(self._stats)
+
+    def __len__(self):
+        return len(self._stats)
 
 
-def _openvpn_compatible(host):
-    features = host['features']
-    return features['openvpn_udp'] and features['openvpn_tcp']
+def _read_disk_cache(filename, ttl):
+    path = DISK_CACHE_DIR / filename
+    try:
+        if time.time() - path.stat().st_mtime < ttl:
+            return orjson.loads(path.read_bytes())
+    except (OSError, ValueError):  # missing, unreadable or corrupt
+        pass
+    return None
+
+
+def _write_disk_cache(filename, data):
+    tmp = None
+    try:
+        DISK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so readers never see partial data
+        with tempfile.NamedTemporaryFile(dir=DISK_CACHE_DIR, prefix='.',
+                                         delete=False) as tmp:
+            tmp.write(orjson.dumps(data))
+        os.replace(tmp.name, DISK_CACHE_DIR / filename)
+    except OSError:  # caching is best-effort
+        if tmp is not None:
+            with suppress(OSError):
+                os.unlink(tmp.name)
+
+
+def _least_loaded_per_location(hosts):
+    """Return the domain of the least loaded host at each location."""
+    best_per_location = {}
+    for host in hosts:
+        location, load = host['location'], host['load']
+        loc = location['lat'], location['long']
+        best = best_per_location.get(loc)
+        if best is None or load < best['load']:
+            best_per_location[loc] = host
+    return [host['domain'] for host in best_per_location.values()]
+
+
+def _rank(loads, rtts, max_load):
+    """Return indices that sort hosts from best to worst."""
+    # TODO: come up with a better ranking
+    scores = [(load / max_load) * rtt for load, rtt in zip(loads, rtts)]
+    return sorted(range(len(scores)), key=scores.__getitem__)
 
 
 class Client:
@@ -62,22 +142,50 @@ class Client:
     Instances of this class can be used as async context managers
     to auto-close the session with the Nord API on exit.
 
+    A single HTTP session, with its pool of keep-alive connections,
+    is shared by all requests made through an instance. The session
+    is created when the first request is made. Make related requests
+    through the same instance (as 'nord.cli' and 'nord.web' do);
+    creating a Client per request means a new TLS handshake each time.
+
     Parameters
     ----------
     api_url : str, default: 'https://api.nordvpn.com'
     """
     def __init__(self, api_url='https://api.nordvpn.com/'):
         self.api_url = api_url
+        # endpoints are relative to the base, which must end in '/'
+        self._base_url = yarl.URL(api_url.rstrip('/') + '/')
         client_version = __version__.split('+')[0]
-        self.headers = {
+        self.headers = MappingProxyType({
             'User-Agent': f"nord/{client_version}"
-        }
-        self._session = aiohttp.ClientSession(raise_for_status=True)
+        })
+        self._session = None
         self._log = get_logger(__name__)
+        # (username, password hash) → (valid, expiry time)
+        self._credentials = {}
+
+    def _new_session(self):
+        # All requests go to the same host, so keep a few connections alive
+        # and cache the DNS lookup, rather than reconnecting per request.
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=16,
+            ttl_dns_cache=600,
+            keepalive_timeout=60,
+            enable_cleanup_closed=True,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            raise_for_status=True,
+        )
 
     async def close(self):
-        """Close the underlying aiohttp.ClientSession."""
-        await self._session.close()
+        """Close the underlying aiohttp.ClientSession and its connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     async def __aenter__(self):
         return self
@@ -85,16 +193,37 @@ class Client:
     async def __aexit__(self, exc_typ, exc, traceback):
         await self.close()
 
+    def _get(self, endpoint):
+        url = self._base_url.join(yarl.URL(endpoint))
+        self._log.log(TRACE, f"hitting {url}")
+        if self._session is None:
+            self._session = self._new_session()
+        return self._session.get(url)
+
     async def _get_json(self, endpoint):
-        url = ''.join((self.api_url, endpoint))
-        self._log.log(TRACE, f"hitting {url} for JSON")
-        async with self._session.get(url, headers=self.headers) as resp:
-            return await resp.json()
+        async with self._get(endpoint) as resp:
+            if resp.content_type != 'application/json':
+                raise aiohttp.ContentTypeError(
+                    resp.request_info, resp.history,
+                    message=f'unexpected mimetype: {resp.content_type}',
+                    headers=resp.headers,
+                )
+            # parse the raw bytes; orjson does not need them decoded first
+            return orjson.loads(await resp.read())
+
+    async def _get_json_disk_cached(self, endpoint):
+        url = self._base_url
+        filename = f"{url.host}_{url.port}-{endpoint.replace('/', '-')}.json"
+        data = _read_disk_cache(filename, DISK_CACHE_TTL)
+        if data is None:
+            data = await self._get_json(endpoint)
+            _write_disk_cache(filename, data)
+        else:
+            self._log.log(TRACE, f"using cached {endpoint} from disk")
+        return data
 
     async def _get_text(self, endpoint):
-        url = ''.join((self.api_url, endpoint))
-        self._log.log(TRACE, f"hitting {url} for text")
-        async with self._session.get(url, headers=self.headers) as resp:
+        async with self._get(endpoint) as resp:
             return await resp.text()
 
     # API methods
@@ -126,10 +255,10 @@ class Client:
 
         Returns
         -------
-        load : int or (dict: str → int)
+        load : int or (Mapping: str → int)
             If 'host' was provided, returns the load on the host as
-            a percentage, otherwise returns a map from hostname
-            to percentage load.
+            a percentage, otherwise returns a read-only map from
+            hostname to percentage load.
         """
         if host:
             host = normalized_hostname(host)
@@ -143,7 +272,7 @@ class Client:
                 raise KeyError(f'{host} does not exist')
             return resp['percent']
         else:
-            return {host: load['percent'] for host, load in resp.items()}
+            return _HostLoads(resp)
 
     async def current_ip(self):
         """Return our current public IP address, as detected by NordVPN."""
@@ -158,16 +287,23 @@ class Client:
         -------
         host_info : (dict: str → dict)
             A map from hostnames to host info dictionaries.
+
+        Notes
+        -----
+        The response is cached on disk for 'DISK_CACHE_TTL' seconds.
         """
         self._log.debug("getting information on all hosts")
-        info = await self._get_json('server')
+        info = await self._get_json_disk_cached('server')
         return {h['domain']: h for h in info}
 
     @async_lru_cache()
     async def dns_servers(self):
-        """Return a list of ip addresses of NordVPN DNS servers."""
+        """Return a list of ip addresses of NordVPN DNS servers.
+
+        The response is cached on disk for 'DISK_CACHE_TTL' seconds.
+        """
         self._log.debug("getting DNS servers")
-        return await self._get_json('dns/smart')
+        return await self._get_json_disk_cached('dns/smart')
 
     async def valid_credentials(self, username, password):
         """Return True if NordVPN accepts the username and password.
@@ -180,21 +316,42 @@ class Client:
         Parameters
         ----------
         username, password : str
+
+        Notes
+        -----
+        Results are cached, so that repeated checks do not hit the API.
+        Rejected credentials are re-checked after
+        'INVALID_CREDENTIALS_TTL' seconds.
         """
+        # Only a hash of the password is kept in the cache.
+        key = (username, sha256(password.encode()).digest())
+        valid, expires = self._credentials.get(key, (None, 0))
+        if time.monotonic() < expires:
+            return valid
+
+        valid = await self._check_credentials(username, password)
+        ttl = float('inf') if valid else INVALID_CREDENTIALS_TTL
+        self._credentials[key] = valid, time.monotonic() + ttl
+        return valid
+
+    async def _check_credentials(self, username, password):
         try:
             resp = await self._get_json(f'token/token/{username}')
-        except aiohttp.ClientResponseError as error:
+        except aiohttp.ContentTypeError:
             # If the username is incorrect the Nord API returns at 200
             # response, but the mimetype is set to HTML. lol.
-            if error.code == 0 and 'unexpected mimetype' in error.message:
-                return False
-            else:
-                raise
+            return False
 
-        token, salt, key = (resp[k] for k in ['token', 'salt', 'key'])
-
-        round1 = sha512(salt.encode() + password.encode())
-        round2 = sha512(round1.hexdigest().encode() + key.encode())
+        try:
+            token, salt, key = resp['token'], resp['salt'], resp['key']
+        except (KeyError, TypeError):
+            return False  # no token was issued for this username
+
+        # The API expects hex digests, so round 2 must hash round 1's hex.
+        round1 = sha512(salt.encode())
+        round1.update(password.encode())
+        round2 = sha512(round1.hexdigest().encode())
+        round2.update(key.encode())
         response = round2.hexdigest()
 
         try:
@@ -205,7 +362,8 @@ class Client:
             else:
                 raise
 
-    async def rank_hosts(self, country_code, max_load=70, ping_timeout=1):
+    async def rank_hosts(self, country_code, max_load=70, ping_timeout=1,
+                         skip_ping_threshold=1):
         """Return hosts ranked by their suitability.
 
         First, all the NordVPN hosts are filtered to get a list of candidates,
@@ -225,6 +383,9 @@ class Client:
         ping_timeout : int
             Each host will be pinged for this amount of time.
             Larger values yield more accurate round-trip times.
+        skip_ping_threshold : int, default: 1
+            If at most this many datacenters have suitable hosts then
+            they are not pinged, and are ranked by their load alone.
 
         Returns
         -------
@@ -243,52 +404,37 @@ class Client:
         # filter out invalid hosts
         info = await self.host_info()
 
-        def _valid_host(info):
-            return (_openvpn_compatible(info)
-                    and info['flag'] == country_code
-                    and info['load'] < max_load)
-
-        candidates = [info for info in info.values()
-                      if _valid_host(info)]
+        # The country is the most selective criterion, so check it first.
+        candidates = [
+            host for host in info.values()
+            if host['flag'] == country_code
+            and host['load'] < max_load
+            and host['features']['openvpn_udp']
+            and host['features']['openvpn_tcp']
+        ]
 
         if not candidates:
             raise ValueError('No host meets the required criteria')
 
-        # select host from each datacenter with lowest load
-        candidates_per_location = defaultdict(lambda: dict(load=float('inf')))
-        for c in candidates:
-            loc = c['location']['lat'], c['location']['long']
-            if c['load'] < candidates_per_location[loc]['load']:
-                candidates_per_location[loc] = c
-
-        candidates = [host['domain']
-                      for host in candidates_per_location.values()]
+        candidates = _least_loaded_per_location(candidates)
 
-        if len(candidates) == 1:
-            return candidates
+        if len(candidates) <= skip_ping_threshold:
+            return sorted(candidates, key=lambda host: info[host]['load'])
 
         # Get round-trip time to each datacenter representative.
         # We assume this will be equal for machines in the same
         # datacenter, which justifies our pre-selecting only
         # the host with the smallest load from each datacenter.
 
-        async def _ping(host):
-            try:
-                return await ping(host, ping_timeout)
-            except SubprocessError:
-                return float('inf')
-
-        self._log.info(f"pinging {len(candidates)} servers")
-        self._log.debug(f"pinging {candidates}")
-        host_rtt = await asyncio.gather(*[_ping(host) for host in candidates])
-        for host, rtt in zip(candidates, host_rtt):
-            info[host]['rtt'] = rtt
-
-        # sort by candidate score
-
-        def _score(host):
-            load, rtt = info[host]['load'], info[host]['rtt']
-            # TODO: come up with a better ranking
-            return (load / max_load) * rtt
-
-        return sorted(candidates, key=_score)
+        # Resolve all the candidates up front, so that the round-trip
+        # times do not include DNS lookups. Hosts that cannot be
+        # resolved are ranked as if they did not respond to the ping.
+        addresses = await resolve_many(candidates)
+        self._log.info(f"pinging {len(addresses)} servers")
+        self._log.debug(f"pinging {addresses}")
+        address_rtt = await ping_many(set(addresses.values()), ping_timeout)
+
+        loads = [info[host]['load'] for host in candidates]
+        rtts = [address_rtt.get(addresses.get(host), float('inf'))
+                for host in candidates]
+        return [candidates[i] for i in _rank(loads, rtts, max_load)]
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Command-line interface to the NordVPN client."""
 
+import os
 import sys
 import traceback
 import signal
@@ -23,17 +24,20 @@ import logging
 import argparse
 import asyncio
 import ipaddress
+import functools as ft
 
-import structlog
-from termcolor import colored
-import aiohttp
-import aiohttp.web
-
-from . import api, vpn, __version__
-from . import web as nord_web
+# Third-party packages and 'api', 'vpn' and 'web' (and hence aiohttp) are
+# imported where they are used, to keep 'nord --help' and '--version' fast.
+from . import get_logger
 from ._utils import sudo_requires_password, prompt_for_sudo, LockError
 
 
+# Number of host configs to request at once when looking for a usable host
+CONFIG_PREFETCH = 4
+# Seconds to wait for cancelled tasks to finish when exiting
+CANCEL_TIMEOUT = 1.0
+
+
 class Abort(RuntimeError):
     """Signal the command-line interface to abort."""
 
@@ -47,82 +51,213 @@ def main():
 
     setup_logging(args)
 
-    # set up the event loop
-    loop = asyncio.get_event_loop()
-    for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(sig, cancel_all_tasks)
+    _use_uvloop()
+    _use_pidfd_child_watcher()
 
     # dispatch
     try:
-        returncode = loop.run_until_complete(command(args))
+        returncode = asyncio.run(_run(command, args))
     except asyncio.CancelledError:
         returncode = 1
     except Abort as error:
-        print(f"{colored('Error', 'red', attrs=['bold'])}:", error)
+        print(f"{_bold('Error', 'red')}:", error)
         returncode = 1
-    finally:
-        remaining_tasks = cancel_all_tasks()
-        if remaining_tasks:
-            loop.run_until_complete(asyncio.wait(remaining_tasks))
-        loop.close()
 
     sys.exit(returncode)
 
 
-def cancel_all_tasks():
-    """Cancel all outstanding tasks on the default event loop."""
-    remaining_tasks = asyncio.Task.all_tasks()
+async def _run(command, args):
+    """Run a subcommand, cancelling it on SIGHUP, SIGINT or SIGTERM."""
+    loop = asyncio.get_running_loop()
+    this_task = asyncio.current_task()
+    for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, this_task.cancel)
+    try:
+        return await command(args)
+    finally:
+        # 'asyncio.run' would wait indefinitely for any stragglers
+        remaining_tasks = cancel_all_tasks(loop)
+        if remaining_tasks:
+            await asyncio.wait(remaining_tasks, timeout=CANCEL_TIMEOUT)
+
+
+def _use_uvloop():
+    """Use uvloop's faster event loop for 'asyncio.run', if it is installed."""
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def _use_pidfd_child_watcher():
+    """Watch child processes using pidfds, if possible.
+
+    The default child watcher on Python 3.8-3.11 starts a new thread
+    to wait on each child process. Python 3.12 uses pidfds by default
+    when they are supported.
+    """
+    if not (3, 9) <= sys.version_info < (3, 12):
+        return
+    # Alternative loops (e.g. uvloop) manage child processes themselves
+    policy = asyncio.get_event_loop_policy()
+    if type(policy) is not asyncio.DefaultEventLoopPolicy:
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):  # not Linux, or kernel < 5.3
+        return
+    # The event loop policy attaches the watcher to the loop that
+    # 'asyncio.run' creates.
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+
+
+def cancel_all_tasks(loop):
+    """Cancel all outstanding tasks on 'loop', except the current one."""
+    current = asyncio.current_task(loop)
+    remaining_tasks = {t for t in asyncio.all_tasks(loop) if t is not current}
     for task in remaining_tasks:
         task.cancel()
     return remaining_tasks
 
 
-def render_logs(logger, _, event):
+@ft.lru_cache(maxsize=None)
+def _bold(text, color=None):
+    """Return 'text' in bold (and 'color'), if stdout is a terminal.
+
+    Results are cached, as the same few strings are styled repeatedly.
+    """
+    if not sys.stdout.isatty():
+        return text
+    from termcolor import colored
+    return colored(text, color, attrs=['bold'])
+
+
+_STATUS_STYLE = {'up': ('connected', 'green'),
+                 'down': ('disconnected', 'red')}
+
+
+def _render_status(event):
+    return _bold(*_STATUS_STYLE[event['event']])
+
+
+def _render_stdout(event):
+    # Lines are logged undecoded, and include the trailing newline
+    return '[stdout @ %s] %s' % (event['timestamp'], event['event'].rstrip())
+
+
+def _render_default(event):
+    if event.get('exc_info'):
+        return ''.join(traceback.format_exception(*event['exc_info']))
+    return str(event['event'])
+
+
+_RENDERERS = {'status': _render_status, 'stdout': _render_stdout}
+
+
+@ft.lru_cache(maxsize=None)
+def _log_prefix(logger_name):
+    # There are only a handful of loggers, so build each prefix once
+    return '[%s] ' % _bold(logger_name)
+
+
+def render_logs(_, __, event):
     """Render logs into a format suitable for CLI output."""
-    if event.get('stream', '') == 'status':
-        if event['event'] == 'up':
-            msg = colored('connected', 'green', attrs=['bold'])
-        elif event['event'] == 'down':
-            msg = colored('disconnected', 'red', attrs=['bold'])
-    elif event.get('stream', '') == 'stdout':
-        msg = f"[stdout @ {event['timestamp']}] {event['event']}"
-    elif event.get('exc_info'):
-        msg = traceback.format_exception(*event['exc_info'])
-    else:
-        msg = f"{event['event']}"
-    return f"[{colored(logger.name, attrs=['bold'])}] {msg}"
+    render = _RENDERERS.get(event.get('stream'), _render_default)
+    return _log_prefix(event['logger']) + render(event)
 
 
 def setup_logging(args):
     """Set up logging."""
-    cfg = structlog.get_config()
-    cfg['processors'].append(render_logs)
-
-    logging.basicConfig(
-        stream=sys.stdout,
-        level=(logging.DEBUG if hasattr(args, 'debug') and args.debug
-               else logging.INFO),
-        format='%(message)s',
+    import structlog
+
+    level = (logging.DEBUG if hasattr(args, 'debug') and args.debug
+             else logging.INFO)
+
+    def _logger_factory(name):
+        # 'add_logger_name' needs a 'name' attribute
+        logger = structlog.WriteLogger(sys.stdout)
+        logger.name = name
+        return logger
+
+    # Write straight to stdout rather than going through 'logging';
+    # messages below 'level' are dropped before any processor runs.
+    structlog.configure(
+        processors=(
+            structlog.stdlib.add_logger_name,
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt="%x:%X", utc=False),
+            structlog.processors.UnicodeDecoder(),
+            render_logs,
+        ),
+        logger_factory=_logger_factory,
+        wrapper_class=structlog.make_filtering_bound_logger(level),
+        cache_logger_on_first_use=True,
+        context_class=dict,
     )
 
     # silence 'asyncio' logging
     logging.getLogger('asyncio').propagate = False
 
 
-def parse_arguments():
+class _VersionAction(argparse.Action):
+    """Print the version and exit.
+
+    Unlike argparse's 'version' action, the version is only determined
+    when the option is given, as doing so may require running 'git'.
+    """
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        # pylint: disable=redefined-builtin
+        super().__init__(option_strings=option_strings, dest=dest,
+                         default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from ._version import __version__
+        print(f'nord {__version__}')
+        parser.exit()
+
+
+def parse_arguments(argv=None):
     """Return a parser for the Nord command-line interface."""
+    argv = sys.argv[1:] if argv is None else argv
+
     parser = argparse.ArgumentParser(
         'nord',
         description='An unofficial NordVPN client')
     subparsers = parser.add_subparsers(dest='command')
 
-    parser.add_argument('--version', action='version',
-                        version=f'nord {__version__}')
+    parser.add_argument('--version', action=_VersionAction)
+
+    # Only build the parsers that are needed: the requested subcommand,
+    # all of them for 'nord --help' or an unknown command (to list the
+    # choices), and none for e.g. 'nord --version'.
+    command = next((arg for arg in argv if not arg.startswith('-')), None)
+    options = argv[:argv.index(command)] if command else argv
+    wants_help = not argv or {'-h', '--help'} & set(options)
+    if command in _SUBPARSERS and not wants_help:
+        _SUBPARSERS[command](subparsers)
+    elif command or wants_help:
+        for add_parser in _SUBPARSERS.values():
+            add_parser(subparsers)
+
+    args = parser.parse_args(argv)
 
+    if not args.command:
+        parser.error('no command provided')
+
+    return args
+
+
+def _add_ip_address_parser(subparsers):
     subparsers.add_parser(
         'ip_address',
         help="Get our public IP address, as reported by NordVPN.")
 
+
+def _add_connect_parser(subparsers):
     connect_parser = subparsers.add_parser(
         'connect',
         help="connect to a NordVPN server",
@@ -165,7 +300,13 @@ def parse_arguments():
     connect_parser.add_argument('--max-load', type=int, default=70,
                                 help='Reject hosts that have a load greater '
                                      'than this threshold')
+    connect_parser.add_argument('--skip-ping-threshold', type=int, default=1,
+                                help='Do not ping the candidate hosts if '
+                                     'there are at most this many, and rank '
+                                     'them by load instead')
 
+
+def _add_web_parser(subparsers):
     web_parser = subparsers.add_parser(
         'web',
         help="Run nord as a web app",
@@ -189,42 +330,50 @@ def parse_arguments():
     passwd.add_argument('-f', '--password-file', type=argparse.FileType(),
                         help='Path to file containing NordVPN password')
 
-    args = parser.parse_args()
-
-    if not args.command:
-        parser.error('no command provided')
 
-    return args
+_SUBPARSERS = dict(
+    ip_address=_add_ip_address_parser,
+    connect=_add_connect_parser,
+    web=_add_web_parser,
+)
 
 
 # Subcommands
 
 async def ip_address(_):
     """Get our public IP address."""
+    from . import api
     async with api.Client() as client:
         print(await client.current_ip())
 
 
 async def connect(args):
     """Connect to a NordVPN server."""
+    from . import api, vpn
 
     username = args.username
     password = args.password or args.password_file.readline().strip()
 
-    # Group requests together to reduce overall latency
-    async with api.Client() as client:
-        output = await asyncio.gather(
-            _get_host_and_config(client, args),
-            client.valid_credentials(username, password),
-            client.dns_servers(),
-            sudo_requires_password(),
-        )
-    (host, config), valid_credentials, dns_servers, require_sudo = output
+    # Start the 'sudo' check first, so that its subprocess overlaps
+    # with connecting to the API.
+    sudo_check = asyncio.ensure_future(sudo_requires_password())
+    try:
+        # Group requests together to reduce overall latency
+        async with api.Client() as client:
+            output = await asyncio.gather(
+                _get_host_and_config(client, args),
+                client.valid_credentials(username, password),
+                client.dns_servers(),
+            )
+        require_sudo = await sudo_check
+    finally:
+        sudo_check.cancel()  # does nothing if it already finished
+    (host, config), valid_credentials, dns_servers = output
 
     if not valid_credentials:
         raise Abort('invalid username/password combination')
 
-    log = structlog.get_logger(__name__)
+    log = get_logger(__name__)
     log.info(f"connecting to {host}")
 
     if require_sudo:
@@ -246,6 +395,9 @@ async def connect(args):
 
 async def web(args):
     """Run nord as a web app"""
+    import aiohttp.web
+    from . import api
+    from . import web as nord_web
 
     username = args.username
     password = args.password or args.password_file.readline().strip()
@@ -274,8 +426,7 @@ async def web(args):
         await runner.setup()
         site = aiohttp.web.TCPSite(runner, str(args.host), args.port)
         await site.start()
-        print(colored(f'=== Listening {args.host}:{args.port} ===',
-                      color='white', attrs=['bold']))
+        print(_bold(f'=== Listening {args.host}:{args.port} ===', 'white'))
         try:
             await app['shutdown_signal'].wait()
         finally:
@@ -283,6 +434,8 @@ async def web(args):
 
 
 async def _get_host_and_config(client, args):
+    import aiohttp
+    from . import api
     # get the host
     if args.server:
         try:
@@ -292,17 +445,24 @@ async def _get_host_and_config(client, args):
     else:
         assert args.country_code
         hosts = await client.rank_hosts(args.country_code,
-                                        args.max_load, args.ping_timeout)
+                                        args.max_load, args.ping_timeout,
+                                        args.skip_ping_threshold)
         if not hosts:
             raise Abort('no hosts available '
                         '(try a higher load or ping threshold?)')
-    # get the config
-    for host in hosts:
-        try:
-            config = await client.host_config(host)
-            return host, config
-        except aiohttp.ClientResponseError as error:
-            if error.code != 404:
-                raise  # unexpected error
+    # Get the config for the best host that has one. Configs for the next
+    # few hosts are requested concurrently, in case the best is missing.
+    for i in range(0, len(hosts), CONFIG_PREFETCH):
+        batch = hosts[i:i + CONFIG_PREFETCH]
+        configs = await asyncio.gather(
+            *(client.host_config(host) for host in batch),
+            return_exceptions=True,
+        )
+        for host, config in zip(batch, configs):
+            if not isinstance(config, Exception):
+                return host, config
+            elif not (isinstance(config, aiohttp.ClientResponseError)
+                      and config.code == 404):
+                raise config  # unexpected error
     # pylint: disable=undefined-loop-variable
     raise Abort(f"config unavailable for {host}")
@@ -16,11 +16,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Tools for starting and supervising OpenVPN clients."""
 
+import os
 import sys
 import asyncio
 
-from structlog import get_logger
-
+from . import get_logger
 from ._utils import (write_to_tmp, lock_subprocess, kill_root_process,
                      require_sudo, maintain_sudo, multi_context,
                      replace_content_as_root)
@@ -30,6 +30,24 @@ OPENVPN_EXECUTABLE = '/usr/sbin/openvpn'
 LOCKFILE = '/run/lock/nordvpn.lockfile'
 _OPENVPN_UP = b'Initialization Sequence Completed'
 
+_log = get_logger(__name__)
+
+
+def _detach_args():
+    # Detach the child from the current process group so as to
+    # avoid signals destined for *this* process.
+    # *we* handle signals properly with 'kill_root_process'.
+    # A new session ('start_new_session') would also do this, but would
+    # detach OpenVPN's 'sudo' from our terminal, and hence from the
+    # credentials cached by 'prompt_for_sudo'.
+    loop = asyncio.get_event_loop()
+    if (sys.version_info >= (3, 11)
+            and isinstance(loop, asyncio.BaseEventLoop)):
+        # done in C, without calling back into Python in the child
+        return dict(process_group=0)
+    else:  # older Pythons, or loops like uvloop
+        return dict(preexec_fn=os.setpgrp)
+
 
 class OpenVPNError(RuntimeError):
     """Errors from the OpenVPN subprocess"""
@@ -62,7 +80,7 @@ async def start(config, username, password):
     client in a subprocess. The lock is released when the process
     dies.
     """
-    logger = get_logger(__name__)
+    logger = _log
 
     config_file = write_to_tmp(config)
     credentials_file = write_to_tmp(f'{username}\n{password}')
@@ -75,29 +93,31 @@ async def start(config, username, password):
 
     proc = None
 
-    # detach the child from the current process group so as to
-    # avoid signals destined for *this* process.
-    # *we* handle signals properly with 'kill_root_process'
-    def _protect_child():
-        import os
-        os.setpgrp()
-
     try:
         proc = await lock_subprocess(*cmd, stdout=asyncio.subprocess.PIPE,
-                                     preexec_fn=_protect_child,
-                                     lockfile=LOCKFILE)
-        logger = logger.bind(pid=proc.pid)
+                                     lockfile=LOCKFILE, **_detach_args())
+        logger = _log.bind(pid=proc.pid)
 
         # Wait until OpenVPN connects, indicated by a particular line in stdout
         stdout = b''
-        while _OPENVPN_UP not in stdout:
-            stdout = await proc.stdout.readline()
-            if not stdout:
-                # 'readline' returned empty; stdout is closed.
-                # Even if OpenVPN is not dead, we have no way of knowing
-                # whether the connection is up or not, so we kill it anyway.
-                raise OpenVPNError('OpenVPN failed to start')
-            logger.debug(stdout.decode().rstrip(), stream='stdout')
+        try:
+            while True:
+                try:
+                    stdout += await proc.stdout.readuntil(_OPENVPN_UP)
+                    break
+                except asyncio.LimitOverrunError as error:
+                    # The buffer filled up without the sentinel appearing
+                    stdout += await proc.stdout.readexactly(error.consumed)
+            stdout += await proc.stdout.readline()  # rest of the line
+        except asyncio.IncompleteReadError as error:
+            # stdout is closed.
+            # Even if OpenVPN is not dead, we have no way of knowing
+            # whether the connection is up or not, so we kill it anyway.
+            stdout += error.partial
+            raise OpenVPNError('OpenVPN failed to start')
+        finally:
+            for line in stdout.splitlines():
+                logger.debug(line, stream='stdout')
 
     except OpenVPNError:
         logger.debug('failed to start')
@@ -140,11 +160,11 @@ async def supervise(proc):
     returncode : int
          'proc.returncode'.
     """
-    logger = get_logger(__name__).bind(pid=proc.pid)
+    logger = _log.bind(pid=proc.pid)
     try:
         stdout = await proc.stdout.readline()
         while stdout:
-            logger.debug(stdout.decode().rstrip(), stream='stdout')
+            logger.debug(stdout, stream='stdout')
             stdout = await proc.stdout.readline()
         # stdout is closed -- wait for the process to terminate
         await proc.wait()
@@ -152,9 +172,9 @@ async def supervise(proc):
         logger.debug('received cancellation')
     else:
         stdout, _ = await proc.communicate()
-        stdout = (l.rstrip() for l in stdout.decode().split('\n'))
-        for line in (l for l in stdout if l):
-            logger.debug(line, stream='stdout')
+        for line in stdout.splitlines():
+            if line.strip():
+                logger.debug(line, stream='stdout')
         logger.warn('unexpected exit', return_code=proc.returncode)
     finally:
         logger.debug('cleaning up OpenVPN')
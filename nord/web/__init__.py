@@ -100,18 +100,33 @@ message to all connected peers in the following example format::
 import asyncio
 import os.path
 from os.path import abspath, dirname
+from functools import lru_cache
+from hashlib import sha256
 
-from structlog import get_logger
 from aiohttp import web
 
 from . import api
 
 STATIC_FOLDER_PATH = os.path.join(abspath(dirname(__file__)), 'static')
+INDEX_PATH = os.path.join(STATIC_FOLDER_PATH, 'index.html')
 
 
-async def index(_):
+@lru_cache(maxsize=None)
+def _index_page():
+    # Read on first request rather than on import, as the frontend
+    # is only built when making a distribution.
+    with open(INDEX_PATH, 'rb') as index_file:
+        body = index_file.read()
+    return body, f'"{sha256(body).hexdigest()}"'
+
+
+async def index(request):
     """Serve frontend files."""
-    return web.FileResponse(os.path.join(STATIC_FOLDER_PATH, 'index.html'))
+    body, etag = _index_page()
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers={'ETag': etag})
+    return web.Response(body=body, content_type='text/html',
+                        headers={'ETag': etag})
 
 
 def init_app(client, credentials):
@@ -134,10 +149,7 @@ def init_app(client, credentials):
 
     app['credentials'] = credentials
     app['client'] = client
-    app['peers'] = set()
-    app['queue'] = asyncio.Queue(loop=app.loop)
-    app['log'] = get_logger(__name__)
-    app['shutdown_signal'] = asyncio.Event(loop=app.loop)
+    app['shutdown_signal'] = asyncio.Event()
 
     app.on_startup.append(api.on_startup)
     app.on_cleanup.append(api.on_cleanup)
@@ -17,84 +17,93 @@
 """Main API for the nord web app."""
 
 import asyncio
-import json
 import sys
 import functools
 
 import aiohttp
+import orjson
 from aiohttp import web, http_websocket
 
-from .. import vpn
+from .. import vpn, get_logger
+
+_log = get_logger(__name__)
+
+_METHODS = frozenset(['connect', 'disconnect'])
 
 
 async def on_startup(app):
     """invoked on app startup."""
-    app['queue'] = queue = asyncio.Queue(loop=app.loop)
+    app['queue'] = queue = asyncio.Queue()
     app['peers'] = peers = set()
+    broadcasts = asyncio.Queue()
+    app['broadcast_coroutine'] = app.loop.create_task(
+        _broadcast(peers, broadcasts))
     app['vpn_coroutine'] = app.loop.create_task(
         _run_vpn(
             functools.partial(_connect, app, app['client']),
-            functools.partial(_send, peers),
+            functools.partial(_send, broadcasts),
             functools.partial(app['shutdown_signal'].set),
             queue,
-            app['log'],
+            _log,
         )
     )
-    app['log'].info('started')
+    _log.info('started')
     app['shutdown_signal'].clear()
 
 
 async def on_cleanup(app):
     """invoked on app cleanup."""
-    app['log'].info('closing downstream websockets')
+    _log.info('closing downstream websockets')
     if app['peers']:
         await asyncio.wait([
             ws.close(code=http_websocket.WSCloseCode.GOING_AWAY,
                      message='Server shutdown')
             for ws in app['peers']
         ])
-    app['log'].info('closing NordVPN client connection')
+    _log.info('closing NordVPN client connection')
     await _stop(app['vpn_coroutine'])
+    await _stop(app['broadcast_coroutine'])
 
 
 async def _run_vpn(connect_vpn, send_peers, on_shutdown, queue, log):
     """Manage the single OpenVPN connection."""
     vpn_task = None
+    get_message = queue.get
     while True:
         try:
-            message = await queue.get()
+            message = await get_message()
             if message['method'] == 'connect':
                 country = message['country']
                 log.info('VPN connect', country=country)
-                await send_peers(state='connecting', country=country)
+                send_peers(state='connecting', country=country)
                 await _stop(vpn_task)
                 vpn_task = None
                 host, vpn_task = await connect_vpn(country)
-                await send_peers(state='connected', host=host)
+                send_peers(state='connected', host=host)
             elif message['method'] == 'disconnect':
                 log.info('VPN disconnect')
-                await send_peers(state='disconnecting')
+                send_peers(state='disconnecting')
                 await _stop(vpn_task)
                 vpn_task = None
-                await send_peers(state='disconnected')
+                send_peers(state='disconnected')
         except asyncio.CancelledError:
             break
         except Exception as err:
             log.error('unexpected exception occurred', exc_info=sys.exc_info())
             await _stop(vpn_task)
-            await send_peers(state='error', message=err.args[0])
+            send_peers(state='error', message=err.args[0])
 
     log.info('stopping VPN')
     await _stop(vpn_task)
     on_shutdown()
-    await send_peers(state='error', message='Backend disconnected')
+    send_peers(state='error', message='Backend disconnected')
 
 
 async def handler(request):
     """Manage a given client websocket connection."""
-    log = request.app['log'].bind(ip_address=request.remote)
+    log = _log.bind(ip_address=request.remote)
     peers = request.app['peers']
-    queue = request.app['queue']
+    put_message = request.app['queue'].put
 
     websocket = web.WebSocketResponse(autoping=True, heartbeat=1)
     await websocket.prepare(request)
@@ -113,7 +122,7 @@ async def handler(request):
                 except Exception:
                     log.warning('received malformed message', message=msg.data)
                 else:
-                    await queue.put(parsed_msg)
+                    await put_message(parsed_msg)
     except asyncio.CancelledError:
         pass
     except Exception:
@@ -126,20 +135,32 @@ async def handler(request):
 # Utilities
 
 def _parse_message(raw):
-    msg = json.loads(raw)
-    assert msg['method'] in ('connect', 'disconnect')
-    if msg['method'] == 'connect':
+    msg = orjson.loads(raw)
+    method = msg['method']
+    if method not in _METHODS:
+        raise ValueError(f'unknown method {method!r}')
+    if method == 'connect':
         msg['country'] = msg['country'].lower()
     return msg
 
 
 
-async def _send(peers, **message):
-    if peers:
-        await asyncio.wait([
-            p.send_json(message)
-            for p in peers
-        ])
+def _send(broadcasts, **message):
+    broadcasts.put_nowait(message)
+
+
+async def _broadcast(peers, broadcasts):
+    """Send each message from the 'broadcasts' queue to all peers."""
+    try:
+        while True:
+            message = await broadcasts.get()
+            if peers:
+                # Serialize once, rather than once per peer in 'send_json'
+                payload = orjson.dumps(message).decode()
+                await asyncio.gather(*[p.send_str(payload) for p in peers],
+                                     return_exceptions=True)
+    except asyncio.CancelledError:
+        pass
 
 
 async def _connect(app, client, country):
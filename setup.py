@@ -16,87 +16,107 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
-from setuptools import setup, find_packages
-
-
-if sys.version_info < (3, 6):
-    print('nord requires Python 3.6 or above.')
-    sys.exit(1)
-
-requirements = [
-    'decorator',
-    'structlog>=18.1',
-    'aiohttp>=3.0',
-    'termcolor',
-]
-
-dev_requirements = [
-    'pylint',
-    'pep8',
-    'sphinx',
-    'sphinx-autobuild',
-    'sphinx-rtd-theme',
-]
-
-classifiers =[
-    'Development Status :: 2 - Pre-Alpha',
-    'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
-    'Operating System :: POSIX :: Linux',
-    'Programming Language :: Python :: 3.6',
-    'Intended Audience :: End Users/Desktop',
-    'Intended Audience :: Developers',
-    'Topic :: Utilities',
-]
-
-with open('README.rst') as readme_file:
-    long_description = readme_file.read()
+from setuptools import setup
+
+# The static metadata is declared in pyproject.toml; only the version, and
+# the commands that record it, are computed here.
+
+# Options that only print metadata, and so do not need the custom commands
+_METADATA_QUERIES = {'--name', '--version', '--fullname', '--description',
+                     '--url', '--license', '--author', '--author-email'}
+metadata_query = len(sys.argv) > 1 and set(sys.argv[1:]) <= _METADATA_QUERIES
+
+# Commands that only write metadata. These are what the PEP 517 hooks
+# run to get the build requirements and the metadata of a wheel.
+_METADATA_COMMANDS = {'egg_info', 'dist_info'}
+_BUILD_COMMANDS = {'build', 'sdist', 'install', 'develop', 'editable_wheel'}
+metadata_only = (
+    bool(_METADATA_COMMANDS.intersection(sys.argv[1:]))
+    and not any(arg in _BUILD_COMMANDS or arg.startswith('bdist')
+                for arg in sys.argv[1:])
+)
 
 
 # Loads _version.py module without importing the whole package.
-def get_version_and_cmdclass(package_name):
-    import os
+def load_version_module(package_name):
     from importlib.util import module_from_spec, spec_from_file_location
     spec = spec_from_file_location('version',
                                    os.path.join(package_name, '_version.py'))
     module = module_from_spec(spec)
     spec.loader.exec_module(module)
-    return module.__version__, module.cmdclass
-
-
-version, cmdclass = get_version_and_cmdclass('nord')
-
-
-class sdist(cmdclass['sdist']):
-    def run(self):
-        import subprocess
-        subprocess.check_call(['yarn', 'install'])
-        subprocess.check_call(['yarn', 'build'])
-        super().run()
-
-
-cmdclass.update(dict(sdist=sdist))
-
-setup(
-    name='nord',
-    author='Joseph Weston',
-    author_email='joseph@weston.cloud',
-    description='Unofficial NordVPN client',
-    license='GNU General Public License v3',
-    version=version,
-    url='https://github.com/jbweston/nord',
-    cmdclass=cmdclass,
-    platforms=['GNU/Linux'],
-    packages=find_packages('.'),
-    long_description=long_description,
-    install_requires=requirements,
-    extras_require={
-        'dev': dev_requirements,
-    },
-    entry_points='''
-        [console_scripts]
-        nord=nord.cli:main
-    ''',
-    package_data={'nord.web': ['static/*']},
-    include_package_data=True,
-)
+    return module
+
+
+# Reads the version that is recorded when making a distribution,
+# without executing anything. Returns None in a git checkout, where
+# the version must be computed from git by executing _version.py.
+def get_static_version(package_name):
+    import ast
+    with open(os.path.join(package_name, '_static_version.py')) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if (isinstance(node, ast.Assign)
+                and any(getattr(target, 'id', None) == 'version'
+                        for target in node.targets)):
+            version = ast.literal_eval(node.value)
+            return None if version == '__use_git__' else version
+    return None
+
+
+# The web frontend is built from these into 'nord/web/static'
+FRONTEND_DEPENDENCIES = ['package.json', 'yarn.lock']
+FRONTEND_SOURCES = [*FRONTEND_DEPENDENCIES, 'webpack.config.js', 'web']
+FRONTEND_OUTPUT = os.path.join('nord', 'web', 'static')
+
+
+def newest_mtime(paths):
+    """Return the latest modification time of any file in 'paths'."""
+    mtimes = [0]
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                mtimes.extend(os.path.getmtime(os.path.join(root, f))
+                              for f in files)
+        elif os.path.exists(path):
+            mtimes.append(os.path.getmtime(path))
+    return max(mtimes)
+
+
+def building_frontend_first(sdist_orig):
+    """Return an 'sdist' command that first builds the web frontend."""
+
+    class sdist(sdist_orig):
+        def run(self):
+            import subprocess
+            if not os.path.exists('package.json'):
+                # Not a git checkout, but an unpacked sdist: this already
+                # contains the built frontend, but not its sources.
+                super().run()
+                return
+            # Only run yarn if its inputs changed since it was last run
+            integrity = os.path.join('node_modules', '.yarn-integrity')
+            if (newest_mtime([integrity])
+                    <= newest_mtime(FRONTEND_DEPENDENCIES)):
+                subprocess.run(['yarn', 'install'], check=True)
+            if (newest_mtime([FRONTEND_OUTPUT])
+                    <= newest_mtime(FRONTEND_SOURCES)):
+                subprocess.run(['yarn', 'build'], check=True)
+            super().run()
+
+    return sdist
+
+
+version = get_static_version('nord') if metadata_query else None
+version_module = load_version_module('nord') if version is None else None
+if version is None:
+    version = version_module.__version__
+
+if metadata_query or metadata_only:
+    cmdclass = {}  # the custom commands only matter when building
+else:
+    cmdclass = version_module.cmdclass
+    cmdclass.update(sdist=building_frontend_first(cmdclass['sdist']))
+
+setup(version=version, cmdclass=cmdclass)